@@ -0,0 +1,326 @@
+# Copyright 2016-2021 Red Hat Inc & Xena Networks.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Contributors:
+#   Christian Trautman, Red Hat Inc.
+#
+
+"""
+Benchmark XenaJSON config operations on synthetic x2544 configs and fail on
+regressions against a saved baseline.
+"""
+
+import argparse
+import base64
+import gc
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from XenaVerify import XenaJSON, _FLOWS, write_json_file
+
+_LOGGER = logging.getLogger(__name__)
+_SAMPLE_TIME = 0.01
+_REPEATS = 15
+
+# Ethernet header with IPv4 ethertype and a 20 byte IPv4 header
+_ETH_SEGMENT = bytes([0x52, 0x54, 0x00, 0xC6, 0x10, 0x10,
+                      0x52, 0x54, 0x00, 0xC6, 0x10, 0x20, 0x08, 0x00])
+_IP_SEGMENT = bytes([0x45, 0x00, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00,
+                     0x7F, 0xFF, 0x25, 0xEA, 0x0A, 0x00, 0x01, 0x01,
+                     0x0A, 0x00, 0x00, 0x01])
+
+
+def generate_config(entities=2, packet_sizes=7, modifiers=0):
+    """
+    Generate a synthetic x2544 config
+    :param entities: number of stream entities, the first two are active
+    :param packet_sizes: number of custom packet sizes
+    :param modifiers: number of hardware modifiers already on each entity
+    :return: dictionary of json data
+    """
+    flow = _FLOWS['1M']
+    entity_list = []
+    for index in range(entities):
+        hw_modifiers = [{
+            'Mask': flow['masks'][i % 2],
+            'Action': 'INC',
+            'Offset': flow['offsets'][i % 2],
+            'StartValue': 0,
+            'StepValue': 1,
+            'StopValue': flow['stops'][i % 2],
+            'RepeatCount': flow['repeats'][i % 2],
+            'SegmentId': 'ip-{}'.format(index),
+            'FieldName': 'Src IP Addr',
+        } for i in range(modifiers)]
+        entity_list.append({
+            'ItemID': 'entity-{}'.format(index),
+            'Label': 'Stream {}'.format(index),
+            'StreamConfig': {
+                'HeaderSegments': [
+                    {'ItemID': 'eth-{}'.format(index),
+                     'SegmentType': 'ETHERNET',
+                     'SegmentValue': base64.b64encode(_ETH_SEGMENT).decode(
+                         'ascii')},
+                    {'ItemID': 'ip-{}'.format(index),
+                     'SegmentType': 'IP',
+                     'SegmentValue': base64.b64encode(_IP_SEGMENT).decode(
+                         'ascii')},
+                ],
+                'HwModifiers': hw_modifiers,
+            },
+        })
+    return {
+        'TestOptions': {
+            'PacketSizes': {
+                'CustomPacketSizes': [64 + 64 * i for i in range(packet_sizes)],
+            },
+            'TestTypeOptionMap': {
+                'Throughput': {
+                    'Duration': 30,
+                    'ReportPropertyOptions': [],
+                    'RateIterationOptions': {
+                        'InitialValue': 100.0,
+                        'MinimumValue': 1.0,
+                        'MaximumValue': 100.0,
+                        'ValueResolution': 0.5,
+                        'AcceptableLoss': 0.0,
+                    },
+                },
+            },
+        },
+        'StreamProfileHandler': {
+            'ProfileAssignmentMap': dict(
+                ('port-{}'.format(index), 'entity-{}'.format(index))
+                for index in range(min(entities, 2))),
+            'EntityList': entity_list,
+        },
+        'ReportConfig': {},
+    }
+
+
+_CALIBRATION_DATA = None
+
+
+def _calibration(_argument=None):
+    """
+    Fixed json round trip timed next to every run, times are compared
+    relative to it so a slower host or a busy moment is not reported as a
+    regression
+    :param _argument: unused, keeps the signature of the operations
+    :return: None
+    """
+    json.loads(json.dumps(_CALIBRATION_DATA, indent=2, sort_keys=True))
+
+
+def _timed(function, arguments):
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for argument in arguments:
+            function(argument)
+        return time.perf_counter() - start
+    finally:
+        gc.enable()
+
+
+def _arguments(setup, number, fresh):
+    if fresh:
+        return [setup() for _ in range(number)]
+    return [setup()] * number
+
+
+def _batch_size(setup, operation, fresh=True):
+    """
+    Find the number of calls per timed sample so a sample takes at least
+    _SAMPLE_TIME, like timeit autorange. This also warms up the operation.
+    :param setup: callable without arguments returning the operation argument
+    :param operation: callable taking the setup result
+    :param fresh: give every call its own setup result
+    :return: number of calls
+    """
+    number = 1
+    while _timed(operation, _arguments(setup, number, fresh)) < _SAMPLE_TIME:
+        number *= 2
+    return number
+
+
+def _measure(setup, operation, repeats, fresh=True):
+    """
+    Run an operation several times. Each sample times a batch of calls so
+    short operations stay well above the timer resolution. Timing runs are
+    not traced, peak memory is taken from one extra traced run.
+    :param setup: callable without arguments returning the operation argument,
+     not measured
+    :param operation: callable taking the setup result
+    :param repeats: number of timed samples
+    :param fresh: give every call its own setup result, operations that give
+     the same result when repeated can share one
+    :return: Tuple of median time per call in seconds, median time relative
+     to the calibration sample before it and peak memory in bytes
+    """
+    number = _batch_size(setup, operation, fresh)
+    calibration_number = _batch_size(lambda: None, _calibration, False)
+    times = []
+    ratios = []
+    for _ in range(repeats):
+        arguments = _arguments(setup, number, fresh)
+        calibration = _timed(_calibration, [None] * calibration_number) / \
+            calibration_number
+        elapsed = _timed(operation, arguments) / number
+        times.append(elapsed)
+        ratios.append(elapsed / calibration)
+    argument = setup()
+    tracemalloc.start()
+    try:
+        operation(argument)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return statistics.median(times), statistics.median(ratios), peak
+
+
+def run_benchmarks(config_path, output_path, flow_count='1M',
+                   repeats=_REPEATS):
+    """
+    Benchmark the XenaJSON operations on a config file
+    :param config_path: path of the config to read
+    :param output_path: path write_config writes to
+    :param flow_count: key of _FLOWS used for modify_flows
+    :param repeats: number of timed samples per operation, the median is
+     kept
+    :return: dictionary of operation name to time and peak memory
+    """
+    load = lambda: XenaJSON(config_path)
+    # loading takes longer than the address changes, those only set fields
+    # and are repeated on one config. modify_flows first clears the existing
+    # modifiers, so it needs a fresh config for every call.
+    operations = [
+        ('init', lambda: config_path, XenaJSON, False),
+        ('modify_flows', load, lambda xena_json: xena_json.modify_flows(
+            flow_count, True, True), True),
+        ('modify_ip_address', load, lambda xena_json:
+            xena_json.modify_ip_address(['10.0.0.1', '10.0.0.2']), False),
+        ('modify_mac_address', load, lambda xena_json:
+            xena_json.modify_mac_address(['52:54:00:00:00:01',
+                                          '52:54:00:00:00:02']), False),
+        ('write_config', load, lambda xena_json:
+            xena_json.write_config(output_path), False),
+    ]
+    global _CALIBRATION_DATA
+    _CALIBRATION_DATA = generate_config(entities=4, packet_sizes=7,
+                                        modifiers=20)
+    results = {}
+    for name, setup, operation, fresh in operations:
+        elapsed, relative, peak = _measure(setup, operation, repeats, fresh)
+        results[name] = {'time': elapsed, 'relative_time': relative,
+                         'peak_memory': peak}
+    return results
+
+
+def find_regressions(results, baseline, threshold):
+    """
+    Compare results against a baseline
+    :param results: dictionary returned by run_benchmarks
+    :param baseline: dictionary returned by an earlier run_benchmarks
+    :param threshold: allowed increase as a fraction, 0.2 allows 20% more
+    :return: list of regression descriptions
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        # time is compared relative to the calibration run of the same host
+        for metric in ('relative_time', 'peak_memory'):
+            old = baseline.get(name, {}).get(metric)
+            if old and result[metric] > old * (1 + threshold):
+                regressions.append('{} {} {:.6g} > baseline {:.6g}'.format(
+                    name, metric, result[metric], old))
+    return regressions
+
+
+def main(args):
+    _LOGGER.setLevel(logging.DEBUG if args.debug else logging.INFO)
+    stream_logger = logging.StreamHandler(sys.stdout)
+    stream_logger.setFormatter(logging.Formatter(
+        '[%(levelname)-5s]  %(asctime)s : (%(name)s) - %(message)s'))
+    _LOGGER.addHandler(stream_logger)
+    work_dir = tempfile.mkdtemp(prefix='xena-bench-')
+    config_path = os.path.join(work_dir, 'synthetic.x2544')
+    output_path = os.path.join(work_dir, 'out.x2544')
+    try:
+        if not write_json_file(generate_config(
+                args.entities, args.packet_sizes, args.modifiers),
+                               config_path):
+            raise RuntimeError('Could not write synthetic config')
+        _LOGGER.info('Synthetic config: %s entities, %s packet sizes, %s '
+                     'modifiers, %s bytes', args.entities, args.packet_sizes,
+                     args.modifiers, os.path.getsize(config_path))
+        results = run_benchmarks(config_path, output_path, args.flow_count,
+                                 args.repeats)
+    finally:
+        for path in (config_path, output_path):
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(work_dir)
+
+    for name, result in results.items():
+        _LOGGER.info('{:<20} {:>12.6f} s {:>12} bytes peak'.format(
+            name, result['time'], result['peak_memory']))
+    if args.save_baseline:
+        write_json_file(results, args.save_baseline)
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.loads(baseline_file.read())
+        regressions = find_regressions(results, baseline, args.threshold)
+        for regression in regressions:
+            _LOGGER.error('Regression: %s', regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--entities', type=int, required=False,
+                        default=24, help='Number of stream entities')
+    parser.add_argument('-k', '--packet_sizes', type=int, required=False,
+                        default=7, help='Number of custom packet sizes')
+    parser.add_argument('-m', '--modifiers', type=int, required=False,
+                        default=100,
+                        help='Hardware modifiers already on each entity')
+    parser.add_argument('-u', '--flow_count', required=False, default='1M',
+                        choices=list(_FLOWS.keys()),
+                        help='Flows used for modify_flows')
+    parser.add_argument('-r', '--repeats', type=int, required=False,
+                        default=_REPEATS, help='Timed samples per operation')
+    parser.add_argument('-b', '--baseline', type=str, required=False,
+                        help='Baseline json file to compare against')
+    parser.add_argument('-s', '--save_baseline', type=str, required=False,
+                        help='Save results as baseline json file')
+    parser.add_argument('-t', '--threshold', type=float, required=False,
+                        default=0.2,
+                        help='Allowed increase over the baseline as a '
+                             'fraction, default = 0.2')
+    parser.add_argument('-d', '--debug', action='store_true', required=False,
+                        help='Enable debug logging')
+    args = parser.parse_args()
+    sys.exit(main(args))
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,493 @@
+# Copyright 2016-2021 Red Hat Inc & Xena Networks.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Contributors:
+#   Christian Trautman, Red Hat Inc.
+#   Flavio Leitner, Red Hat Inc.
+#   Greg Dumas, Red Hat Inc.
+
+"""
+Local job daemon that keeps reserved chassis sessions open between jobs.
+
+Jobs are sent as one JSON line over a Unix socket and answered with JSON
+lines until a final line with a status key. Jobs for the same port pair are
+queued and run in order, jobs for different port pairs run concurrently
+except searches, which run one at a time. Monitor jobs do not reserve ports
+and run right away.
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+from xenalib.XenaSocket import XenaSocket
+from xenalib.XenaManager import XenaManager
+from xenalib.XenaPort import XenaPort
+
+import XenaPktSend
+import XenaVerify
+
+_LOGGER = logging.getLogger(__name__)
+_XENA_USER = 'TestUser'
+_SOCKET_PATH = '/tmp/xena-daemon.sock'
+_IDLE_TIMEOUT = 600
+# XenaVerify writes ./2bUsed.x2544, ./verify.x2544, the report and the shared
+# Valkyrie2544 log, concurrent searches would overwrite each other
+_SEARCH_LOCK = threading.Lock()
+_VERIFY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'XenaVerify.py')
+
+
+class XenaSession(object):
+    """
+    Connected and reserved chassis session for one port pair.
+    """
+    def __init__(self, chassis, module, ports):
+        """
+        Constructor
+        :param chassis: Xena chassis IP
+        :param module: module number
+        :param ports: list of two port numbers, first one sends traffic
+        :return: XenaSession object
+        """
+        self.chassis = chassis
+        self.module = module
+        self.port_numbers = ports
+        self._connect()
+
+    def _connect(self):
+        self.xena_socket = XenaSocket(self.chassis)
+        self.xena_socket.connect()
+        self.manager = XenaManager(self.xena_socket, _XENA_USER)
+        self.ports = [self.manager.add_port(self.module, port)
+                      for port in self.port_numbers]
+        self.streams = []
+        # number_streams the modifiers of the streams were added with
+        self.number_streams = None
+        self.reserve()
+
+    def reopen(self):
+        """
+        Connect again with new port objects and reset the ports, used once
+        another application has configured them
+        :return: None
+        """
+        del self.manager
+        del self.xena_socket
+        self._connect()
+        for port in self.ports:
+            port.reset()
+
+    def reserve(self):
+        """
+        Reserve the ports of the session
+        :return: None
+        """
+        for port in self.ports:
+            port.reserve()
+
+    def release(self):
+        """
+        Release the ports so other applications can use them
+        :return: None
+        """
+        for port in self.ports:
+            port.release()
+        # streams are lost once another application owns the ports
+        self.streams = []
+
+    def close(self):
+        """
+        Release the ports and disconnect from the chassis
+        :return: None
+        """
+        try:
+            self.release()
+        finally:
+            del self.manager
+            del self.xena_socket
+
+
+class PairWorker(threading.Thread):
+    """
+    Thread that runs the queued jobs of one port pair in order.
+    """
+    def __init__(self, key, idle_timeout=_IDLE_TIMEOUT):
+        """
+        Constructor
+        :param key: tuple of chassis, module and ports
+        :param idle_timeout: seconds without jobs before the session is closed
+        :return: PairWorker object
+        """
+        super(PairWorker, self).__init__(name='xena-{}'.format(key))
+        self.daemon = True
+        self.key = key
+        self.jobs = queue.Queue()
+        self.idle_timeout = idle_timeout
+        self.session = None
+
+    def submit(self, job):
+        """
+        Queue a job for this port pair
+        :param job: dictionary of job options
+        :return: queue the job results are put on, None marks the end
+        """
+        replies = queue.Queue()
+        self.jobs.put((job, replies))
+        return replies
+
+    def run(self):
+        while True:
+            try:
+                job, replies = self.jobs.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self._close_session()
+                continue
+            try:
+                if self.session is None:
+                    chassis, module, ports = self.key
+                    self.session = XenaSession(chassis, module, list(ports))
+                for result in _HANDLERS[job['type']](self.session, job):
+                    replies.put(result)
+                replies.put({'status': 'done'})
+            except Exception as exc:
+                _LOGGER.exception('Job failed on %s', self.key)
+                # the session may be in an unknown state, start over
+                self._close_session()
+                replies.put({'status': 'error', 'message': str(exc)})
+            finally:
+                replies.put(None)
+
+    def _close_session(self):
+        if self.session is not None:
+            try:
+                self.session.close()
+            except Exception:
+                _LOGGER.exception('Could not close session %s', self.key)
+            self.session = None
+
+
+def run_send_job(session, job):
+    """
+    Send one or more packet sizes on the pooled session
+    :param session: XenaSession
+    :param job: dictionary with pkt_size list, imix, pps, duration and
+     number_streams
+    :return: generator of XenaPktSend iteration results
+    """
+    sweep = XenaPktSend.build_sweep(
+        job.get('pkt_size') or ([] if job.get('imix') else [1500]),
+        job.get('imix'))
+    port0, port1 = session.ports
+    number_streams = job.get('number_streams', 1024)
+    if session.streams and session.number_streams != number_streams:
+        # the modifier is set when a stream is added, start over
+        for stream_id in range(len(session.streams)):
+            port0.del_stream(stream_id)
+        session.streams = []
+    session.number_streams = number_streams
+    # streams are added once per session and reused by later jobs
+    for stream_id in range(len(session.streams),
+                           max(len(mix) for mix in sweep)):
+        session.streams.append(XenaPktSend.add_stream(
+            port0, stream_id, number_streams))
+    for mix in sweep:
+        yield XenaPktSend.run_iteration(
+            port0, port1, session.streams, mix, job.get('pps', 1000),
+            job.get('duration', 60))
+
+
+def run_monitor_job(job):
+    """
+    Report total lost frames of both ports at every interval. Like
+    XenaLossMonitor the ports are not reserved, so monitors run outside the
+    port pair queue and can watch traffic of running jobs.
+    :param job: dictionary with chassis, module, ports, interval and length
+     in seconds
+    :return: generator of loss results
+    """
+    xena_socket = XenaSocket(job['chassis'])
+    xena_socket.connect()
+    manager = XenaManager(xena_socket, 'Monitor')
+    ports = [XenaPort(xena_socket, job['module'], port)
+             for port in job.get('ports', [0, 1])]
+    try:
+        interval = job.get('interval', 60)
+        totaltime = 0
+        while totaltime < job.get('length', 3600):
+            time.sleep(interval)
+            totaltime += interval
+            result = {'time': totaltime}
+            for index, port in enumerate(ports):
+                port.grab_all_rx_stats()
+                result['port{}_lost'.format(index)] = \
+                    port.get_total_errors_counter()
+            yield result
+    finally:
+        del ports
+        del manager
+        del xena_socket
+
+
+def _config_ports(config_file):
+    """
+    Ports a Valkyrie2544 config runs on
+    :param config_file: path to x2544 config
+    :return: set of (chassis host, module, port) tuples
+    """
+    config = XenaVerify.read_json_file(config_file)
+    hosts = dict((chassis.get('ChassisID'), chassis.get('HostName'))
+                 for chassis in config.get('ChassisManager', {}).get(
+                     'ChassisList', []))
+    ports = set()
+    for entity in config.get('PortHandler', {}).get('EntityList', []):
+        port_ref = entity.get('PortRef', {})
+        ports.add((hosts.get(port_ref.get('ChassisId')),
+                   port_ref.get('ModuleIndex'), port_ref.get('PortIndex')))
+    return ports
+
+
+def check_search_ports(job):
+    """
+    Make sure the config of a search job uses the ports of the job, the
+    daemon only releases the job ports while Valkyrie2544 runs
+    :param job: dictionary with chassis, module, ports and config_file
+    :return: None
+    """
+    config_ports = _config_ports(job['config_file'])
+    if not config_ports:
+        raise ValueError('No ports found in {}'.format(job['config_file']))
+    job_ports = set((job['module'], port) for port in job.get('ports', [0, 1]))
+    if set((module, port) for _, module, port in config_ports) != job_ports \
+            or any(host not in (None, job['chassis'])
+                   for host, _, _ in config_ports):
+        raise ValueError('Config {} runs on {}, job is for {} {}'.format(
+            job['config_file'], sorted(config_ports, key=str),
+            job['chassis'], sorted(job_ports)))
+
+
+def run_search_job(session, job):
+    """
+    Run XenaVerify on the port pair. Valkyrie2544 opens its own connection so
+    the ports are released while it runs. Afterwards the session is reopened
+    and the ports reset, as they hold the Valkyrie2544 configuration.
+    XenaVerify uses fixed config, report and log file names, searches are
+    run one at a time across the whole daemon.
+    :param session: XenaSession
+    :param job: dictionary with config_file, cwd holding Valkyrie2544.exe and
+     optional list of extra XenaVerify arguments
+    :return: generator of log lines
+    """
+    args = [sys.executable, _VERIFY_SCRIPT, '-f', job['config_file']] + \
+        job.get('args', [])
+    with _SEARCH_LOCK:
+        session.release()
+        try:
+            verify = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT,
+                                      universal_newlines=True,
+                                      cwd=job.get('cwd'))
+            for line in verify.stdout:
+                yield {'log': line.rstrip()}
+            yield {'returncode': verify.wait()}
+        finally:
+            session.reopen()
+
+
+# jobs run in the queue of their port pair on the reserved session
+_HANDLERS = {
+    'send': run_send_job,
+    'search': run_search_job,
+}
+# jobs run right away in the connection thread without reserving ports
+_UNQUEUED_HANDLERS = {
+    'monitor': run_monitor_job,
+}
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix socket server dispatching jobs to one worker per port pair.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, idle_timeout=_IDLE_TIMEOUT):
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, JobHandler)
+        self.idle_timeout = idle_timeout
+        self.workers = {}
+        self.workers_lock = threading.Lock()
+
+    def get_worker(self, job):
+        """
+        Get or start the worker for the port pair of a job
+        :param job: dictionary with chassis, module and ports
+        :return: PairWorker
+        """
+        key = (job['chassis'], job['module'], tuple(job.get('ports', [0, 1])))
+        with self.workers_lock:
+            if key not in self.workers:
+                self.workers[key] = PairWorker(key, self.idle_timeout)
+                self.workers[key].start()
+            return self.workers[key]
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline().decode('utf-8'))
+            if job.get('type') in _UNQUEUED_HANDLERS:
+                self._run_unqueued(job)
+                return
+            if job.get('type') not in _HANDLERS:
+                raise ValueError('Unknown job type {}'.format(job.get('type')))
+            if job['type'] == 'search':
+                check_search_ports(job)
+            replies = self.server.get_worker(job).submit(job)
+        except (ValueError, KeyError, IOError) as exc:
+            self._reply({'status': 'error', 'message': str(exc)})
+            return
+        while True:
+            result = replies.get()
+            if result is None:
+                break
+            self._reply(result)
+
+    def _run_unqueued(self, job):
+        try:
+            for result in _UNQUEUED_HANDLERS[job['type']](job):
+                self._reply(result)
+            self._reply({'status': 'done'})
+        except (BrokenPipeError, ConnectionResetError):
+            _LOGGER.info('Client of %s job went away', job['type'])
+        except Exception as exc:
+            _LOGGER.exception('Job %s failed', job['type'])
+            self._reply({'status': 'error', 'message': str(exc)})
+
+    def _reply(self, result):
+        self.wfile.write((json.dumps(result, sort_keys=True) + '\n').encode(
+            'utf-8'))
+        self.wfile.flush()
+
+
+def submit_job(job, path=_SOCKET_PATH):
+    """
+    Send a job to the daemon and yield its results as they arrive
+    :param job: dictionary of job options
+    :param path: daemon Unix socket path
+    :return: generator of result dictionaries
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    try:
+        client.sendall((json.dumps(job) + '\n').encode('utf-8'))
+        for line in client.makefile('r', encoding='utf-8'):
+            yield json.loads(line)
+    finally:
+        client.close()
+
+
+def main(args):
+    _LOGGER.setLevel(logging.DEBUG if args.debug else logging.INFO)
+    stream_logger = logging.StreamHandler(sys.stdout)
+    stream_logger.setFormatter(logging.Formatter(
+        '[%(levelname)-5s]  %(asctime)s : (%(name)s) - %(message)s'))
+    _LOGGER.addHandler(stream_logger)
+    if args.command == 'serve':
+        server = JobServer(args.socket, args.idle_timeout)
+        _LOGGER.info('Listening on %s', args.socket)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(args.socket)
+        return 0
+
+    job = {'type': args.command, 'chassis': args.chassis,
+           'module': args.module, 'ports': args.ports}
+    if args.command == 'send':
+        job.update(pkt_size=args.pkt_size, imix=args.imix, pps=args.pps,
+                   duration=args.duration, number_streams=args.number_streams)
+    elif args.command == 'monitor':
+        job.update(interval=args.interval, length=args.length)
+    else:
+        job.update(config_file=os.path.abspath(args.config_file),
+                   cwd=os.getcwd(), args=args.verify_args)
+    status = 0
+    for result in submit_job(job, args.socket):
+        print(json.dumps(result, sort_keys=True))
+        sys.stdout.flush()
+        if result.get('status') == 'error':
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-S', '--socket', type=str, required=False,
+                        default=_SOCKET_PATH, help='Daemon Unix socket path')
+    parser.add_argument('-D', '--debug', action='store_true', required=False,
+                        help='Enable debug logging')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    serve = subparsers.add_parser('serve', help='Run the daemon')
+    serve.add_argument('-t', '--idle_timeout', type=int, required=False,
+                       default=_IDLE_TIMEOUT,
+                       help='Seconds before an idle session is released')
+    for name, help_text in (('send', 'Send traffic with XenaPktSend'),
+                            ('monitor', 'Monitor loss like XenaLossMonitor'),
+                            ('search', 'Run a XenaVerify search')):
+        job_parser = subparsers.add_parser(name, help=help_text)
+        job_parser.add_argument('-c', '--chassis', type=str, required=True,
+                                help='Xena Chassis IP')
+        job_parser.add_argument('-m', '--module', type=int, required=True,
+                                help='Module to use')
+        job_parser.add_argument('-p', '--ports', nargs=2, type=int,
+                                required=False, default=[0, 1],
+                                help='Ports to use, default = 0,1')
+    send = subparsers.choices['send']
+    send.add_argument('-d', '--duration', type=int, required=False,
+                      default=60, help='Duration to run')
+    send.add_argument('-s', '--pkt_size', type=int, required=False,
+                      nargs='+', help='pkt sizes to send, default = 1500')
+    send.add_argument('-i', '--imix', type=str, required=False,
+                      help='IMIX distribution as size:weight pairs')
+    send.add_argument('-f', '--pps', type=int, required=False,
+                      default=1000, help='pkt per second')
+    send.add_argument('-n', '--number_streams', type=int, required=False,
+                      default=1024, help='Number of streams for multistream')
+    monitor = subparsers.choices['monitor']
+    monitor.add_argument('-t', '--interval', type=int, required=False,
+                         default=60, help='Interval to check ports')
+    monitor.add_argument('-l', '--length', type=int, required=False,
+                         default=3600, help='Duration of monitoring')
+    search = subparsers.choices['search']
+    search.add_argument('-f', '--config_file', type=str, required=True,
+                        help='Xena/Valkyrie 2544 json config file name')
+    search.add_argument('verify_args', nargs=argparse.REMAINDER,
+                        help='Extra arguments passed to XenaVerify.py')
+    args = parser.parse_args()
+    sys.exit(main(args))
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -18,6 +18,7 @@
 #   Greg Dumas, Red Hat Inc.
 
 import argparse
+import json
 import locale
 import logging
 import sys
@@ -44,6 +45,395 @@ through socket commands and returning different statistics.
 _LOCALE = locale.getlocale()[1]
 _LOGGER = logging.getLogger(__name__)
 
+_DRAIN_TIMEOUT = 10
+_POLL_INTERVAL = 0.25
+
+
+def _flatten_stats(dumped_stats):
+    """
+    Merge the timestamp keyed dictionary returned by the xenalib dump methods
+    :param dumped_stats: dictionary of {timestamp: stats} from xenalib
+    :return: Tuple of latest timestamp and a single dictionary of stats
+    """
+    stats = {}
+    stamp = None
+    for timestamp in sorted(dumped_stats):
+        stats.update(dumped_stats[timestamp])
+        stamp = timestamp
+    return stamp, stats
+
+
+def grab_stats_snapshot(tx_port, rx_port):
+    """
+    Read the TX counters of the sending port and the RX counters of the
+    receiving port back to back so both describe the same moment.
+    :param tx_port: XenaPort that sends traffic
+    :param rx_port: XenaPort that receives traffic
+    :return: dictionary of tx and rx stats with their chassis timestamps
+    """
+    tx_port.grab_all_tx_stats()
+    rx_port.grab_all_rx_stats()
+    tx_time, tx_stats = _flatten_stats(tx_port.dump_all_tx_stats())
+    rx_time, rx_stats = _flatten_stats(rx_port.dump_all_rx_stats())
+    return {'tx_time': tx_time, 'tx': tx_stats,
+            'rx_time': rx_time, 'rx': rx_stats}
+
+
+def _total_packets(stats, key):
+    return int(stats.get(key, {}).get('packets', 0))
+
+
+def wait_for_tx_done(tx_port, stream_id, packet_limit,
+                     timeout=_DRAIN_TIMEOUT):
+    """
+    Poll the TX stream counter until the packet limit has been sent
+    :param tx_port: XenaPort that sends traffic
+    :param stream_id: stream index on the port
+    :param packet_limit: number of packets the stream is limited to
+    :param timeout: maximum number of seconds to wait
+    :return: Boolean if the limit was reached before the timeout
+    """
+    key = 'pt_stream_{}'.format(stream_id)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        tx_port.grab_all_tx_stats()
+        _, stats = _flatten_stats(tx_port.dump_all_tx_stats())
+        if _total_packets(stats, key) >= packet_limit:
+            return True
+        time.sleep(_POLL_INTERVAL)
+    _LOGGER.warning('Stream %s did not send %s packets in time', stream_id,
+                    packet_limit)
+    return False
+
+
+def wait_for_drain(tx_port, rx_port, timeout=_DRAIN_TIMEOUT):
+    """
+    Poll the counters after traffic stops until the RX counter stops moving
+    instead of sleeping for a fixed time.
+    :param tx_port: XenaPort that sent traffic
+    :param rx_port: XenaPort that received traffic
+    :param timeout: maximum number of seconds to wait for the drain
+    :return: last stats snapshot, see grab_stats_snapshot
+    """
+    deadline = time.time() + timeout
+    snapshot = grab_stats_snapshot(tx_port, rx_port)
+    while time.time() < deadline:
+        time.sleep(_POLL_INTERVAL)
+        previous = _total_packets(snapshot['rx'], 'pr_total')
+        snapshot = grab_stats_snapshot(tx_port, rx_port)
+        received = _total_packets(snapshot['rx'], 'pr_total')
+        if received == previous:
+            return snapshot
+    _LOGGER.warning('RX counters still moving after %s seconds', timeout)
+    return snapshot
+
+
+def stream_loss(snapshot, stream_id, tpld_id):
+    """
+    Calculate loss of a single stream from the TX stream counter and the RX
+    test payload counter, non test traffic on the port is not counted.
+    :param snapshot: stats snapshot, see grab_stats_snapshot
+    :param stream_id: stream index on the sending port
+    :param tpld_id: test payload id of the stream
+    :return: Tuple of packets sent, received and lost
+    """
+    sent = _total_packets(snapshot['tx'], 'pt_stream_{}'.format(stream_id))
+    received = int(snapshot['rx'].get('pr_tpldtraffic', {}).get(
+        str(tpld_id), {}).get('packets', 0))
+    return sent, received, sent - received
+
+
+def parse_imix(imix):
+    """
+    Parse an IMIX distribution
+    :param imix: comma separated size:weight pairs, e.g. 64:7,570:4,1518:1
+    :return: list of (size, weight) tuples
+    """
+    mix = []
+    for entry in imix.split(','):
+        size, _, weight = entry.partition(':')
+        mix.append((int(size), int(weight) if weight else 1))
+    return mix
+
+
+def build_sweep(pkt_sizes, imix=None):
+    """
+    Build the list of iterations for a sweep
+    :param pkt_sizes: list of fixed packet sizes, one iteration each
+    :param imix: optional IMIX distribution string sent as one iteration
+    :return: list of iterations, each a list of (size, weight) tuples
+    """
+    sweep = [[(size, 1)] for size in pkt_sizes]
+    if imix:
+        sweep.append(parse_imix(imix))
+    return sweep
+
+
+def add_stream(port, stream_id, number_streams, header=pkthdr1):
+    """
+    Add a stream with the settings that stay the same across a sweep
+    :param port: XenaPort to add the stream to
+    :param stream_id: stream index, test payload id will be stream_id + 1
+    :param number_streams: number of flows for the modifier, 0 to disable
+    :param header: packet header as hex string
+    :return: XenaStream object
+    """
+    stream = port.add_stream(stream_id)
+    stream.set_packet_header(header)
+    stream.set_packet_payload_incrementing('0x00')
+    stream.set_packet_protocol('ETHERNET', 'IP')
+    stream.set_test_payload_id(stream_id + 1)
+
+    # enable multistream
+    if number_streams:
+        modifier = stream.add_modifier()
+        modifier.set_modifier(32, 0xffff0000, 'inc', 1)
+        modifier.set_modifier_range(0, 1, number_streams)
+    return stream
+
+
+def run_iteration(tx_port, rx_port, streams, mix, pps, duration):
+    """
+    Send one packet size or IMIX distribution on already added streams
+    :param tx_port: XenaPort that sends traffic
+    :param rx_port: XenaPort that receives traffic
+    :param streams: list of streams on tx_port, unused ones are turned off
+    :param mix: list of (size, weight) tuples, pps is split by weight
+    :param pps: total packets per second
+    :param duration: duration of the iteration in seconds
+    :return: dictionary result of the iteration
+    """
+    tx_port.clear_all_tx_stats()
+    rx_port.clear_all_rx_stats()
+    total_weight = sum(weight for _, weight in mix)
+    limits = []
+    for stream_id, stream in enumerate(streams):
+        if stream_id >= len(mix):
+            stream.set_stream_off()
+            continue
+        size, weight = mix[stream_id]
+        stream_pps = max(1, pps * weight // total_weight)
+        stream.set_rate_pps(stream_pps)
+        stream.set_packet_length_fixed(size, 1518)
+        stream.set_packet_limit(duration * stream_pps)
+        stream.set_stream_on()
+        limits.append(duration * stream_pps)
+
+    # begin network traffic
+    tx_port.start_traffic()
+    time.sleep(duration)
+    for stream_id, limit in enumerate(limits):
+        wait_for_tx_done(tx_port, stream_id, limit)
+    tx_port.stop_traffic()
+
+    # retrieve traffic statistics once the receive side has drained
+    snapshot = wait_for_drain(tx_port, rx_port)
+    result = {
+        'pkt_size': mix[0][0] if len(mix) == 1 else ','.join(
+            '{}:{}'.format(size, weight) for size, weight in mix),
+        'tx_time': snapshot['tx_time'],
+        'rx_time': snapshot['rx_time'],
+        'sent': 0, 'received': 0, 'lost': 0,
+        'streams': [],
+    }
+    for stream_id, (size, _) in enumerate(mix):
+        sent, received, lost = stream_loss(snapshot, stream_id, stream_id + 1)
+        latency = snapshot['rx'].get('pr_tpldlatency', {}).get(
+            str(stream_id + 1), {})
+        result['sent'] += sent
+        result['received'] += received
+        result['lost'] += lost
+        result['streams'].append({
+            'pkt_size': size, 'sent': sent, 'received': received,
+            'lost': lost, 'latency_avg': latency.get('avg')})
+    return result
+
+
+_HEADERS = {'pkthdr1': pkthdr1, 'pkthdr2': pkthdr2}
+
+
+def load_profile(profile_path):
+    """
+    Read a traffic profile. Example with one bidirectional stream:
+    {"duration": 60,
+     "ports": {"p0": [1, 0], "p1": [1, 1]},
+     "streams": [{"tx": "p0", "rx": "p1", "header": "pkthdr1",
+                  "pps": 100000, "pkt_size": 64, "bidirectional": true,
+                  "modifiers": [{"position": 32, "mask": "0xffff0000",
+                                 "action": "inc", "repeat": 1,
+                                 "min": 0, "step": 1, "max": 1023}]}]}
+    :param profile_path: path to JSON profile file
+    :return: dictionary of profile with bidirectional streams expanded
+    """
+    with open(profile_path, 'r', encoding=_LOCALE) as profile_file:
+        profile = json.loads(profile_file.read())
+    streams = []
+    for stream in profile['streams']:
+        stream = dict(stream)
+        stream['header'] = _HEADERS.get(stream.get('header', 'pkthdr1'),
+                                        stream.get('header'))
+        streams.append(stream)
+        if stream.pop('bidirectional', False):
+            reverse = dict(stream, tx=stream['rx'], rx=stream['tx'])
+            if 'reverse_header' in stream:
+                reverse['header'] = _HEADERS.get(stream['reverse_header'],
+                                                 stream['reverse_header'])
+            else:
+                reverse['header'] = reverse_header(stream['header'])
+            streams.append(reverse)
+    profile['streams'] = streams
+    return profile
+
+
+def reverse_header(header):
+    """
+    Swap the source and destination MAC and IPv4 addresses of a header
+    :param header: packet header as hex string starting with 0x
+    :return: packet header as hex string for the opposite direction
+    """
+    data = header[2:]
+    data = data[12:24] + data[0:12] + data[24:]
+    if data[24:28] == '0800':
+        # IPv4 source and destination follow 12 bytes into the IP header
+        data = data[:52] + data[60:68] + data[52:60] + data[68:]
+    return '0x' + data
+
+
+def _send_verify(xena_socket, command):
+    """
+    Send a chassis command and check the chassis accepted it
+    :param xena_socket: connected XenaSocket
+    :param command: command string
+    :return: None
+    """
+    reply = xena_socket.sendQueryVerify(command)
+    if reply is not True and '<OK>' not in str(reply):
+        raise RuntimeError('Chassis rejected {}: {}'.format(command, reply))
+
+
+def start_traffic_sync(xena_socket, ports):
+    """
+    Start traffic on several ports with a single chassis command so all
+    ports begin at the same time.
+    :param xena_socket: connected XenaSocket
+    :param ports: list of (module, port) tuples
+    :return: None
+    """
+    _send_verify(xena_socket, 'C_TRAFFIC ON {}'.format(
+        ' '.join('{} {}'.format(module, port) for module, port in ports)))
+
+
+def stop_traffic_sync(xena_socket, ports):
+    """
+    Stop traffic on several ports with a single chassis command
+    :param xena_socket: connected XenaSocket
+    :param ports: list of (module, port) tuples
+    :return: None
+    """
+    _send_verify(xena_socket, 'C_TRAFFIC OFF {}'.format(
+        ' '.join('{} {}'.format(module, port) for module, port in ports)))
+
+
+def grab_ports_snapshot(ports):
+    """
+    Read TX and RX counters of all ports back to back
+    :param ports: dictionary of name to XenaPort
+    :return: dictionary of name to tx and rx stats with timestamps
+    """
+    for port in ports.values():
+        port.grab_all_tx_stats()
+        port.grab_all_rx_stats()
+    snapshot = {}
+    for name, port in ports.items():
+        tx_time, tx_stats = _flatten_stats(port.dump_all_tx_stats())
+        rx_time, rx_stats = _flatten_stats(port.dump_all_rx_stats())
+        snapshot[name] = {'tx_time': tx_time, 'tx': tx_stats,
+                          'rx_time': rx_time, 'rx': rx_stats}
+    return snapshot
+
+
+def run_profile(xena_socket, xm, profile, duration=None):
+    """
+    Configure all ports and streams of a profile and run them together
+    :param xena_socket: connected XenaSocket
+    :param xm: XenaManager session
+    :param profile: dictionary of profile, see load_profile
+    :param duration: duration in seconds, overrides the profile duration
+    :return: list of dictionary results, one per stream
+    """
+    duration = duration or profile.get('duration', 60)
+    ports = {}
+    for name, (module, port_id) in profile['ports'].items():
+        port = xm.add_port(module, port_id)
+        port.reserve()
+        port.clear_all_rx_stats()
+        port.clear_all_tx_stats()
+        ports[name] = port
+
+    # test payload ids have to be unique on the receive side, number them
+    # across the whole profile
+    stream_ids = dict((name, 0) for name in ports)
+    configured = []
+    for tpld_id, entry in enumerate(profile['streams'], start=1):
+        stream_id = stream_ids[entry['tx']]
+        stream_ids[entry['tx']] += 1
+        stream = ports[entry['tx']].add_stream(stream_id)
+        stream.set_packet_limit(duration * entry['pps'])
+        stream.set_stream_on()
+        stream.set_rate_pps(entry['pps'])
+        stream.set_packet_header(entry['header'])
+        stream.set_packet_length_fixed(entry.get('pkt_size', 64), 1518)
+        stream.set_packet_payload_incrementing('0x00')
+        stream.set_packet_protocol('ETHERNET', 'IP')
+        stream.set_test_payload_id(tpld_id)
+        for mod in entry.get('modifiers', []):
+            modifier = stream.add_modifier()
+            modifier.set_modifier(mod['position'], int(mod['mask'], 16),
+                                  mod.get('action', 'inc'),
+                                  mod.get('repeat', 1))
+            modifier.set_modifier_range(mod.get('min', 0),
+                                        mod.get('step', 1), mod['max'])
+        configured.append((entry, stream_id, tpld_id))
+
+    tx_names = sorted(set(entry['tx'] for entry in profile['streams']))
+    tx_ports = [tuple(profile['ports'][name]) for name in tx_names]
+    start_traffic_sync(xena_socket, tx_ports)
+    time.sleep(duration)
+    for entry, stream_id, _ in configured:
+        wait_for_tx_done(ports[entry['tx']], stream_id,
+                         duration * entry['pps'])
+    stop_traffic_sync(xena_socket, tx_ports)
+
+    # poll until every receive counter has settled
+    deadline = time.time() + _DRAIN_TIMEOUT
+    snapshot = grab_ports_snapshot(ports)
+    while time.time() < deadline:
+        time.sleep(_POLL_INTERVAL)
+        previous = snapshot
+        snapshot = grab_ports_snapshot(ports)
+        if all(_total_packets(previous[name]['rx'], 'pr_total') ==
+               _total_packets(snapshot[name]['rx'], 'pr_total')
+               for name in ports):
+            break
+
+    results = []
+    for entry, stream_id, tpld_id in configured:
+        stream_snapshot = {'tx': snapshot[entry['tx']]['tx'],
+                           'rx': snapshot[entry['rx']]['rx']}
+        sent, received, lost = stream_loss(stream_snapshot, stream_id,
+                                           tpld_id)
+        latency = snapshot[entry['rx']]['rx'].get('pr_tpldlatency', {}).get(
+            str(tpld_id), {})
+        results.append({
+            'tx': entry['tx'], 'rx': entry['rx'],
+            'pkt_size': entry.get('pkt_size', 64), 'pps': entry['pps'],
+            'tx_time': snapshot[entry['tx']]['tx_time'],
+            'rx_time': snapshot[entry['rx']]['rx_time'],
+            'sent': sent, 'received': received, 'lost': lost,
+            'latency_avg': latency.get('avg')})
+    return results
+
+
 def main(args):
     _LOGGER.setLevel(logging.INFO)
     stream_logger = logging.StreamHandler(sys.stdout)
@@ -57,6 +447,24 @@ def main(args):
     # create the manager session
     xm = XenaManager(xena_socket, 'TestUser')
     time.sleep(1)
+    if args.profile:
+        try:
+            for result in run_profile(xena_socket, xm,
+                                      load_profile(args.profile),
+                                      args.duration):
+                _LOGGER.info('Stream %s -> %s: sent %s received %s lost %s',
+                             result['tx'], result['rx'], result['sent'],
+                             result['received'], result['lost'])
+                print(json.dumps(result, sort_keys=True))
+        except Exception as e:
+            print('An exception occurred while attempting to run profile')
+            print(e)
+        finally:
+            print('Disconnecting from Xena chassis...')
+            del xm
+            del xena_socket
+            print('Connection severed')
+        return
     try:
         # add port 0 and configure
         port0 = xm.add_port(args.module, args.ports[0])
@@ -72,56 +480,20 @@ def main(args):
         print('An exception occurred while attempting to add and configure ports')
         print(e)
     try:
-        # add a single stream and configure
-        s1_p0 = port0.add_stream(0)
-        s1_p0.set_packet_limit(args.duration * args.pps)
-        s1_p0.set_stream_on()
-        s1_p0.set_rate_pps(args.pps)
-        s1_p0.set_packet_header(pkthdr1)
-        s1_p0.set_packet_length_fixed(args.pkt_size, 1518)
-        s1_p0.set_packet_payload_incrementing('0x00')
-        s1_p0.set_packet_protocol('ETHERNET', 'IP')
-        s1_p0.set_test_payload_id(1)
-        
-        # enable multistream
-        if args.number_streams:
-            m1_s1_p0 = s1_p0.add_modifier()
-            m1_s1_p0.set_modifier(32, 0xffff0000, 'inc', 1)
-            m1_s1_p0.set_modifier_range(0, 1, args.number_streams)
-        
-        # begin network traffic
-        port0.start_traffic()
-        time.sleep(args.duration + 2)
-        port0.stop_traffic()
-        
-        # retrieve traffic statistics
-        port1.grab_all_rx_stats()
-        grab_stats = port1.dump_all_rx_stats()
-        
-        # reorganize stats dict
-        stats = {}
-        for timestamp, stat in grab_stats.items():
-            for key in stat:
-                stats[key] = stat[key]
-
-        # packets sent
-        pkt_sent = args.duration * args.pps
-        print('Packets sent: {}'.format(pkt_sent))
-        
-        # packets received
-        pr_total = stats.get('pr_total')
-        pkt_rec = pr_total.get('packets')
-        
-        # latency
-        pr_tpldlatency = stats.get('pr_tpldlatency')
-        tmp = pr_tpldlatency.get('1')
-        pkt_latency_avg = tmp.get('avg')
-        print('Packet latency: {} ns'.format(pkt_latency_avg))
-        
-        # packets lost
-        pkt_lost = pkt_sent - pkt_rec # sometimes returns negative loss, TODO: find out why
-        print('Packets received: {}'.format(pkt_rec))
-        print('Packets lost: {}'.format(pkt_lost))
+        # configure enough streams for the widest iteration once, between
+        # iterations only the length, limit and rate are changed
+        sweep = build_sweep(args.pkt_size or ([] if args.imix else [1500]),
+                            args.imix)
+        streams = [add_stream(port0, stream_id, args.number_streams)
+                   for stream_id in range(max(len(mix) for mix in sweep))]
+        for mix in sweep:
+            result = run_iteration(port0, port1, streams, mix, args.pps,
+                                   args.duration)
+            _LOGGER.info('Packet size %s: sent %s received %s lost %s',
+                         result['pkt_size'], result['sent'],
+                         result['received'], result['lost'])
+            print(json.dumps(result, sort_keys=True))
+            sys.stdout.flush()
     except Exception as e:
         print('An exception occurred while attempting to add and configure stream')
         print(e)
@@ -140,20 +512,29 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--chassis', type=str, required=True,
                         help='Xena Chassis IP')
-    parser.add_argument('-m', '--module', type=int, required=True,
+    parser.add_argument('-m', '--module', type=int, required=False,
                         help='Module to use')
     parser.add_argument('-p', '--ports', nargs=2, type=int, required=False,
                         default=[0, 1], help='Ports to use, default = 0,1')
     parser.add_argument('-d', '--duration', type=int,
-                        required=False, default=60, help='Duration to run')
+                        required=False, help='Duration to run, default = 60')
     parser.add_argument('-s', '--pkt_size', type=int, required=False,
-                        default=1500, help='pkt size to send')
+                        nargs='+', help='pkt sizes to send, default = 1500')
+    parser.add_argument('-i', '--imix', type=str, required=False,
+                        help='IMIX distribution as size:weight pairs, '
+                             'e.g. 64:7,570:4,1518:1')
     parser.add_argument('-f', '--pps', type=int, required=False,
                         default=1000, help='pkt per second')
     parser.add_argument('-n', '--number_streams', type=int,
                         required=False, default=1024,
                         help='Number of streams for multistream')
+    parser.add_argument('-P', '--profile', type=str, required=False,
+                        help='JSON traffic profile with ports and streams')
     args = parser.parse_args()
+    if args.module is None and not args.profile:
+        parser.error('--module is required unless --profile is used')
+    if not args.profile and args.duration is None:
+        args.duration = 60
     main(args)
 
 
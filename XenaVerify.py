@@ -17,15 +17,25 @@
 #
 
 import argparse
+import asyncio
 import base64
+import copy
+import csv
+import functools
+import glob
+import io
 import json
 import locale
 import logging
+import math
 import os
 import pprint
+import signal
 import subprocess
 import sys
+import time
 import xml.etree.ElementTree as ET
+from dataclasses import dataclass
 from time import sleep
 
 pp = pprint.PrettyPrinter(indent=4)
@@ -80,6 +90,14 @@ _FLOWS = {
     }
 }
 
+_LATENCY_FRACTIONS = [10, 50, 80, 90, 95, 99]
+# watchdog: seconds added to each trial for learning and setup, fixed seconds
+# added to the whole run and seconds between TERM and KILL
+_TRIAL_OVERHEAD = 10
+_WATCHDOG_SLACK = 300
+_KILL_GRACE = 10
+_SIGKILL = getattr(signal, 'SIGKILL', signal.SIGTERM)
+
 class XenaJSON(object):
     """
     Class to modify and read Xena JSON configuration files.
@@ -155,6 +173,7 @@ class XenaJSON(object):
         :return: None
         """
         self.json_data['TestOptions']['PacketSizes']['CustomPacketSizes'] = packet_sizes
+        self.packet_sizes = packet_sizes
 
     def modify_acceptable_loss(self, acceptable_loss):
         """
@@ -182,7 +201,7 @@ class XenaJSON(object):
         
         if len(list_new_macs) == 2:
             for i in range(0, 6):
-                curr_ips[0][i] = int(list_new_macs[1][i], 16)
+                curr_macs[0][i] = int(list_new_macs[1][i], 16)
                 if len(curr_macs) == 2:
                     curr_macs[1][6 + i] = int(list_new_macs[1][i], 16)
                     
@@ -353,6 +372,25 @@ class XenaJSON(object):
         self.json_data['ReportConfig'][
             'SaveIntermediateResults'] = 'true' if int_results else 'false'
 
+    def expected_runtime(self):
+        """
+        Estimate how long Valkyrie2544 needs for this config, a binary search
+        step per resolution halving for every iteration and packet size
+        :return: run time in seconds
+        """
+        throughput = self.json_data['TestOptions']['TestTypeOptionMap'][
+            'Throughput']
+        rates = throughput['RateIterationOptions']
+        span = rates['MaximumValue'] - rates['MinimumValue']
+        steps = 1
+        if span > 0:
+            steps += int(math.ceil(math.log2(
+                span / max(rates['ValueResolution'], 0.001))))
+        packet_sizes = len(self.json_data['TestOptions']['PacketSizes'].get(
+            'CustomPacketSizes') or [1])
+        return (throughput['Duration'] + _TRIAL_OVERHEAD) * steps * \
+            throughput.get('Iterations', 1) * packet_sizes
+
     def write_config(self, path='./2bUsed.x2544'):
         """
         Write the config to out as file
@@ -363,6 +401,291 @@ class XenaJSON(object):
             raise RuntimeError("Could not write out file, please check config")
 
 
+@dataclass
+class PortLatency(object):
+    """
+    Latency counters of one port in microseconds.
+    """
+    __slots__ = ('port_id', 'min_latency', 'max_latency', 'avg_latency')
+    port_id: str
+    min_latency: float
+    max_latency: float
+    avg_latency: float
+
+
+@dataclass
+class TrialResult(object):
+    """
+    Result of a single Valkyrie2544.exe run.
+    """
+    __slots__ = ('state', 'tx_rate_pcnt', 'tx_rate_fps', 'loss_frames',
+                 'latency', 'config_file')
+    state: str
+    tx_rate_pcnt: float
+    tx_rate_fps: float
+    loss_frames: int
+    latency: tuple
+    config_file: str
+
+    @property
+    def passed(self):
+        return self.state == 'PASS'
+
+    @classmethod
+    def from_element(cls, element, config_file=None):
+        """
+        Build the result from the report element of a Valkyrie2544 run
+        :param element: xml Element holding the test results
+        :param config_file: config file used for the run
+        :return: TrialResult
+        """
+        latency = tuple(
+            PortLatency(port.get('ID'), _to_float(port.get('MinLatency')),
+                        _to_float(port.get('MaxLatency')),
+                        _to_float(port.get('AvgLatency')))
+            for port in element if port.get('AvgLatency') is not None)
+        return cls(element.get('TestState'),
+                   float(element.get('TotalTxRatePcnt')),
+                   float(element.get('TotalTxRateFps')),
+                   int(element.get('TotalLossFrames') or 0), latency,
+                   config_file)
+
+
+@dataclass
+class ProgressEvent(object):
+    """
+    Progress of a ThroughputVerifier run passed to the progress callback.
+    kind is one of search_start, search_failed, search_cancelled,
+    search_timeout, verify_start, verify_passed, verify_failed,
+    verify_cancelled, verify_timeout, retries_exhausted or latency_start.
+    """
+    __slots__ = ('kind', 'attempt', 'trial', 'duration', 'initial_value',
+                 'minimum_value', 'maximum_value')
+    kind: str
+    attempt: int
+    trial: TrialResult
+    duration: int
+    initial_value: float
+    minimum_value: float
+    maximum_value: float
+
+
+@dataclass
+class VerifyResult(object):
+    """
+    Final verdict of a ThroughputVerifier run. state is PASS, SEARCH_FAILED,
+    CANCELLED, TIMEOUT or RETRIES_EXHAUSTED, trial is the last trial that was
+    run.
+    """
+    __slots__ = ('state', 'trial', 'attempts', 'trials')
+    state: str
+    trial: TrialResult
+    attempts: int
+    trials: tuple
+
+    @property
+    def passed(self):
+        return self.state == 'PASS'
+
+
+@dataclass
+class LatencyPoint(object):
+    """
+    Latency of one packet size at a fraction of the verified rate.
+    """
+    __slots__ = ('packet_size', 'fraction', 'rate', 'trial')
+    packet_size: int
+    fraction: float
+    rate: float
+    trial: TrialResult
+
+    @property
+    def min_latency(self):
+        return min((port.min_latency for port in self.trial.latency
+                    if port.min_latency is not None), default=None)
+
+    @property
+    def max_latency(self):
+        return max((port.max_latency for port in self.trial.latency
+                    if port.max_latency is not None), default=None)
+
+    @property
+    def avg_latency(self):
+        values = [port.avg_latency for port in self.trial.latency
+                  if port.avg_latency is not None]
+        return sum(values) / len(values) if values else None
+
+
+def _to_float(value):
+    return None if value is None else float(value)
+
+
+class ThroughputVerifier(object):
+    """
+    Search for the throughput of a config and verify it with a longer run,
+    searching again below the failed rate until a verify passes.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, xena_json, verify_duration=600, retry_attempts=5,
+                 smart_search=False, search_trial_duration=0,
+                 windows_mode=False, save_file_name='./2bUsed.x2544',
+                 verify_file_name='./verify.x2544', progress_callback=None,
+                 trial_runner=None):
+        """
+        Constructor
+        :param xena_json: XenaJSON object with the search config, runs work
+         on a copy so it can be reused
+        :param verify_duration: verification duration in seconds
+        :param retry_attempts: maximum verify attempts
+        :param smart_search: resume the search half way to the minimum
+        :param search_trial_duration: search trial duration in seconds, 0
+         keeps the duration of the config
+        :param windows_mode: enable windows mode which bypasses mono
+        :param save_file_name: file the search config is written to
+        :param verify_file_name: file the verify configs are written to
+        :param progress_callback: callable receiving a ProgressEvent
+        :param trial_runner: callable(config_file, windows_mode) returning
+         a TrialResult, defaults to run_trial
+        :return: ThroughputVerifier object
+        """
+        self.xena_json = xena_json
+        self.verify_duration = verify_duration
+        self.retry_attempts = retry_attempts
+        self.smart_search = smart_search
+        self.search_trial_duration = search_trial_duration
+        self.windows_mode = windows_mode
+        self.save_file_name = save_file_name
+        self.verify_file_name = verify_file_name
+        self.progress_callback = progress_callback
+        self.trial_runner = trial_runner or run_trial
+        # config of the last passed verify, latency_curve starts from it
+        self.verified_json = None
+
+    def _progress(self, kind, attempt=0, trial=None, duration=None,
+                  initial_value=None, minimum_value=None,
+                  maximum_value=None):
+        if self.progress_callback:
+            self.progress_callback(ProgressEvent(
+                kind, attempt, trial, duration, initial_value,
+                minimum_value, maximum_value))
+
+    def run(self):
+        """
+        Run the search and verify steps
+        :return: VerifyResult
+        """
+        xena_current = copy.deepcopy(self.xena_json)
+        self.verified_json = None
+        trials = []
+        xena_current.write_config(self.save_file_name)
+        self._progress('search_start', trial=None,
+                       duration=xena_current.duration,
+                       initial_value=xena_current.init_tput,
+                       minimum_value=xena_current.min_tput,
+                       maximum_value=xena_current.max_tput)
+        result = self.trial_runner(self.save_file_name, self.windows_mode)
+        trials.append(result)
+
+        # now run the verification step by creating a new config with the
+        # desired params
+        for attempt in range(1, self.retry_attempts + 1):
+            if result.state in ('CANCELLED', 'TIMEOUT'):
+                self._progress('search_' + result.state.lower(), attempt,
+                               result)
+                return VerifyResult(result.state, result, attempt - 1,
+                                    tuple(trials))
+            if not result.passed:
+                self._progress('search_failed', attempt, result)
+                return VerifyResult('SEARCH_FAILED', result, attempt - 1,
+                                    tuple(trials))
+            old_min = xena_current.min_tput # need this if verify fails
+            old_duration = xena_current.duration
+            xena_current.modify_2544_tput_options(
+                initial_value=result.tx_rate_pcnt,
+                minimum_value=result.tx_rate_pcnt,
+                maximum_value=result.tx_rate_pcnt)
+            xena_current.modify_duration(self.verify_duration)
+            xena_current.write_config(self.verify_file_name)
+            # run verify step
+            self._progress('verify_start', attempt, result,
+                           self.verify_duration, result.tx_rate_pcnt,
+                           result.tx_rate_pcnt, result.tx_rate_pcnt)
+            verify_result = self.trial_runner(self.verify_file_name,
+                                              self.windows_mode)
+            trials.append(verify_result)
+            if verify_result.passed:
+                self.verified_json = xena_current
+                self._progress('verify_passed', attempt, verify_result)
+                return VerifyResult('PASS', verify_result, attempt,
+                                    tuple(trials))
+            if verify_result.state in ('CANCELLED', 'TIMEOUT'):
+                self._progress('verify_' + verify_result.state.lower(),
+                               attempt, verify_result)
+                return VerifyResult(verify_result.state, verify_result,
+                                    attempt, tuple(trials))
+            self._progress('verify_failed', attempt, verify_result)
+            if self.smart_search:
+                new_init = (verify_result.tx_rate_pcnt - old_min) / 2
+            else:
+                new_init = result.tx_rate_pcnt - xena_current.value_thresh
+            new_max = result.tx_rate_pcnt - xena_current.value_thresh
+            new_duration = self.search_trial_duration if \
+                self.search_trial_duration else old_duration
+            xena_current.modify_2544_tput_options(
+                initial_value=new_init, minimum_value=old_min,
+                maximum_value=new_max)
+            xena_current.modify_duration(new_duration)
+            xena_current.write_config(self.verify_file_name)
+            self._progress('search_start', attempt, verify_result,
+                           new_duration, new_init, old_min, new_max)
+            result = self.trial_runner(self.verify_file_name,
+                                       self.windows_mode)
+            trials.append(result)
+        self._progress('retries_exhausted', self.retry_attempts, result)
+        return VerifyResult('RETRIES_EXHAUSTED', result, self.retry_attempts,
+                            tuple(trials))
+
+    def latency_curve(self, rate, fractions=_LATENCY_FRACTIONS,
+                      duration=None, config_file='./latency.x2544',
+                      trial_runner=None):
+        """
+        Run latency trials at fractions of a verified rate, one packet size
+        at a time, each on a copy of the config of the last passed verify, or
+        of the search config if run has not passed
+        :param rate: verified rate in percent
+        :param fractions: list of load percentages of the verified rate
+        :param duration: trial duration in seconds, defaults to the verify
+         duration
+        :param config_file: file the latency configs are written to
+        :param trial_runner: callable used instead of the verifier's trial
+         runner, e.g. one without a search monitor as these trials run at a
+         fixed rate and must not be cancelled by its threshold
+        :return: tuple of LatencyPoint
+        """
+        duration = duration or self.verify_duration
+        trial_runner = trial_runner or self.trial_runner
+        base_json = self.verified_json or self.xena_json
+        points = []
+        for packet_size in base_json.json_data['TestOptions'][
+                'PacketSizes']['CustomPacketSizes']:
+            for fraction in fractions:
+                trial_rate = rate * fraction / 100
+                latency_config = copy.deepcopy(base_json)
+                latency_config.modify_packet_size([packet_size])
+                latency_config.modify_2544_tput_options(
+                    initial_value=trial_rate, minimum_value=trial_rate,
+                    maximum_value=trial_rate)
+                latency_config.modify_duration(duration)
+                latency_config.modify_latency()
+                latency_config.write_config(config_file)
+                self._progress('latency_start', len(points) + 1, None,
+                               duration, trial_rate, trial_rate, trial_rate)
+                points.append(LatencyPoint(
+                    packet_size, fraction, trial_rate,
+                    trial_runner(config_file, self.windows_mode)))
+        return tuple(points)
+
+
 def main(args):
     _LOGGER.setLevel(logging.DEBUG if args.debug else logging.INFO)
     stream_logger = logging.StreamHandler(sys.stdout)
@@ -400,62 +723,101 @@ def main(args):
         xena_current.modify_flows(args.flow_count, not args.use_mac_flows or args.use_both_flows, 
                                  args.use_mac_flows or args.use_both_flows) 
 
-    xena_current.write_config(args.save_file_name)
-
-    result = run_xena(args.save_file_name, args.windows_mode)
-
-    # now run the verification step by creating a new config with the desired
-    # params
-    for _ in range(1, args.retry_attempts +1):
-        if result[0] != 'PASS':
-            _LOGGER.error('Valkyrie2544.exe Test failed. Please check test config.')
-            break
-        _LOGGER.info('Verify attempt {}'.format(_))
-        old_min = xena_current.min_tput # need this if verify fails
-        old_duration = xena_current.duration
-        xena_current.modify_2544_tput_options(initial_value=result[1], minimum_value=result[1],
-                                              maximum_value=result[1])
-        xena_current.modify_duration(args.verify_duration)
-        xena_current.write_config('./verify.x2544')
-        # run verify step
-        _LOGGER.info('Running verify for {} seconds'.format(
-            args.verify_duration))
-        verify_result = run_xena('./verify.x2544', args.windows_mode)
-        if verify_result[0] == 'PASS':
-            _LOGGER.info('Verify passed. Packets lost = {} Exiting'.format(
-                verify_result[3]))
-            _LOGGER.info('Pass result transmit rate = {}'.format(
-                verify_result[1]))
-            _LOGGER.info('Pass result transmit fps = {}'.format(
-                verify_result[2]))
-            if args.collect_latency:
-                for x in verify_result[4]:
-                    _LOGGER.info('Port {}'.format(x.get('ID')))
-                    _LOGGER.info('Latency Min = {} micsec'.format(x.get('MinLatency')))
-                    _LOGGER.info('Latency Max = {} micsec'.format(x.get('MaxLatency')))
-                    _LOGGER.info('Latency Avg = {} micsec'.format(x.get('AvgLatency')))
-            break
-        else:
-            _LOGGER.warning('Verify failed. Packets lost = {}'.format(
-                verify_result[3]))
-            _LOGGER.info('Restarting Valkyrie2544.exe with new values')
-            if args.smart_search:
-                new_init = (verify_result[1] - old_min) / 2
-            else:
-                new_init = result[1] - xena_current.value_thresh
-            xena_current.modify_2544_tput_options(
-                initial_value=new_init, minimum_value=old_min, 
-                maximum_value=result[1] - xena_current.value_thresh)
-            xena_current.modify_duration(
-                args.search_trial_duration if args.search_trial_duration else
-                old_duration)
-            _LOGGER.info('New minimum value: {}'.format(old_min))
-            _LOGGER.info('New maximum value: {}'.format(
-                result[1] - xena_current.value_thresh))
-            _LOGGER.info('New initial rate: {}'.format(new_init))
-            xena_current.write_config('./verify.x2544')
-            result = run_xena('./verify.x2544', args.windows_mode)
-    else:
+    trial_runner = functools.partial(run_trial,
+                                     watchdog_slack=args.watchdog_slack)
+    progress_file = None
+    if args.progress_file or args.cancel_below is not None:
+        if args.progress_file == '-':
+            progress_file = sys.stdout
+        elif args.progress_file:
+            progress_file = open(args.progress_file, 'a')
+        monitor = SearchMonitor(output=progress_file,
+                                cancel_below=args.cancel_below)
+        trial_runner = functools.partial(run_trial, monitor=monitor,
+                                         watchdog_slack=args.watchdog_slack)
+    verifier = ThroughputVerifier(
+        xena_current, verify_duration=args.verify_duration,
+        retry_attempts=args.retry_attempts, smart_search=args.smart_search,
+        search_trial_duration=args.search_trial_duration,
+        windows_mode=args.windows_mode, save_file_name=args.save_file_name,
+        progress_callback=_log_progress, trial_runner=trial_runner)
+    try:
+        result = verifier.run()
+    finally:
+        if progress_file not in (None, sys.stdout):
+            progress_file.close()
+    if result.state == 'PASS' and args.collect_latency:
+        for port in result.trial.latency:
+            _LOGGER.info('Port {}'.format(port.port_id))
+            _LOGGER.info('Latency Min = {} micsec'.format(port.min_latency))
+            _LOGGER.info('Latency Max = {} micsec'.format(port.max_latency))
+            _LOGGER.info('Latency Avg = {} micsec'.format(port.avg_latency))
+    if result.state == 'PASS' and args.latency_curve is not None:
+        points = verifier.latency_curve(
+            result.trial.tx_rate_pcnt, args.latency_curve or
+            _LATENCY_FRACTIONS, args.latency_duration,
+            trial_runner=functools.partial(
+                run_trial, watchdog_slack=args.watchdog_slack))
+        _log_latency_curve(points)
+
+
+def _log_latency_curve(points):
+    """
+    Log the latency/load table, one block per packet size
+    :param points: list of LatencyPoint
+    :return: None
+    """
+    for packet_size in sorted(set(point.packet_size for point in points)):
+        _LOGGER.info('Latency for packet size {}'.format(packet_size))
+        _LOGGER.info('{:>8} {:>10} {:>6} {:>12} {:>12} {:>12}'.format(
+            'Load %', 'Rate %', 'State', 'Min micsec', 'Avg micsec',
+            'Max micsec'))
+        for point in points:
+            if point.packet_size != packet_size:
+                continue
+            _LOGGER.info('{:>8} {:>10.3f} {:>6} {:>12} {:>12} {:>12}'.format(
+                point.fraction, point.rate, point.trial.state,
+                point.min_latency, point.avg_latency, point.max_latency))
+
+
+def _log_progress(event):
+    """
+    Progress callback used by the command line to log the verifier events
+    :param event: ProgressEvent
+    :return: None
+    """
+    trial = event.trial
+    if event.kind == 'verify_start':
+        _LOGGER.info('Verify attempt {}'.format(event.attempt))
+        _LOGGER.info('Running verify for {} seconds'.format(event.duration))
+    elif event.kind == 'search_failed':
+        _LOGGER.error('Valkyrie2544.exe Test failed. Please check test config.')
+    elif event.kind in ('search_timeout', 'verify_timeout'):
+        _LOGGER.error('Valkyrie2544.exe did not finish in time, giving up.')
+    elif event.kind == 'search_cancelled':
+        _LOGGER.error('Valkyrie2544.exe search cancelled at rate {}'.format(
+            trial.tx_rate_pcnt))
+    elif event.kind == 'verify_cancelled':
+        _LOGGER.error('Valkyrie2544.exe verify cancelled')
+    elif event.kind == 'verify_passed':
+        _LOGGER.info('Verify passed. Packets lost = {} Exiting'.format(
+            trial.loss_frames))
+        _LOGGER.info('Pass result transmit rate = {}'.format(
+            trial.tx_rate_pcnt))
+        _LOGGER.info('Pass result transmit fps = {}'.format(
+            trial.tx_rate_fps))
+    elif event.kind == 'verify_failed':
+        _LOGGER.warning('Verify failed. Packets lost = {}'.format(
+            trial.loss_frames))
+        _LOGGER.info('Restarting Valkyrie2544.exe with new values')
+    elif event.kind == 'search_start' and event.attempt:
+        _LOGGER.info('New minimum value: {}'.format(event.minimum_value))
+        _LOGGER.info('New maximum value: {}'.format(event.maximum_value))
+        _LOGGER.info('New initial rate: {}'.format(event.initial_value))
+    elif event.kind == 'latency_start':
+        _LOGGER.info('Running latency trial at rate {} for {} seconds'.format(
+            event.initial_value, event.duration))
+    elif event.kind == 'retries_exhausted':
         _LOGGER.error('Maximum number of verify retries attempted. Exiting...')
 
 
@@ -483,27 +845,133 @@ def read_json_file(json_file):
     return file_data
 
 
-def run_xena(config_file, windows_mode=False):
+def _valkyrie_log_path():
+    """
+    Path of the Valkyrie2544 log, the folder is created if it doesn't exist
+    :return: log file path as str
+    """
+    user_home = os.path.expanduser('~')
+    log_path = '{}/Xena/Valkrie2544/Logs/valkyrie2544.log'.format(user_home)
+    # make the folder and log file if they doesn't exist
+    if not os.path.exists(log_path):
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        open(log_path, 'a').close()
+    return log_path
+
+
+def _valkyrie_args(config_file, windows_mode=False, report_dir='./'):
+    """
+    Build the Valkyrie2544.exe command line
+    :param config_file: config file to use
+    :param windows_mode: enable windows mode which bypasses the usage of mono
+    :param report_dir: folder the report files are written to
+    :return: list of arguments
+    """
+    args = ["Valkyrie2544.exe", "-c", config_file, "-e", "-r", report_dir,
+            "-u", _XENA_USER]
+    return args if windows_mode else ["mono"] + args
+
+
+def _report_element(report_dir='./'):
+    """
+    Read the result element from the Valkyrie2544 xml report
+    :param report_dir: folder the report was written to
+    :return: xml Element holding the test results
+    """
+    root = ET.parse(os.path.join(report_dir,
+                                 'valkyrie2544-report.xml')).getroot()
+    return root[0][1][0]
+
+
+class TrialTimeout(Exception):
+    """
+    Raised when the watchdog kills a trial that ran past its deadline.
+    """
+    def __init__(self, timeout):
+        super(TrialTimeout, self).__init__(
+            'Trial did not finish within {} seconds'.format(timeout))
+        self.timeout = timeout
+
+
+def trial_timeout(config_file, watchdog_slack=_WATCHDOG_SLACK):
+    """
+    Deadline of a trial derived from its config
+    :param config_file: config file to use
+    :param watchdog_slack: seconds added to the expected run time
+    :return: timeout in seconds
+    """
+    return XenaJSON(config_file).expected_runtime() + watchdog_slack
+
+
+def _remove_report(report_dir='./'):
+    report = os.path.join(report_dir, 'valkyrie2544-report.xml')
+    if os.path.exists(report):
+        os.remove(report)
+
+
+def _signal_group(process, sig):
+    try:
+        if hasattr(os, 'killpg'):
+            # started with a new session so the group id is the pid
+            os.killpg(process.pid, sig)
+        elif sig == signal.SIGTERM:
+            process.terminate()
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
+
+def _stop_process_group(process, grace=_KILL_GRACE):
+    """
+    Send TERM to the process group and KILL if it is still there after grace
+    :param process: subprocess.Popen started with start_new_session
+    :param grace: seconds to wait after TERM
+    :return: None
+    """
+    _signal_group(process, signal.SIGTERM)
+    try:
+        process.wait(grace)
+    except subprocess.TimeoutExpired:
+        _signal_group(process, _SIGKILL)
+        process.wait()
+
+
+async def _async_stop_process_group(process, grace=_KILL_GRACE):
+    """
+    Send TERM to the process group and KILL if it is still there after grace
+    :param process: asyncio Process started with start_new_session
+    :param grace: seconds to wait after TERM
+    :return: process return code
+    """
+    _signal_group(process, signal.SIGTERM)
+    try:
+        return await asyncio.wait_for(process.wait(), grace)
+    except asyncio.TimeoutError:
+        _signal_group(process, _SIGKILL)
+        return await process.wait()
+
+
+def run_xena(config_file, windows_mode=False, monitor=None,
+             watchdog_slack=_WATCHDOG_SLACK):
     """
     Run Valkyrie2544.exe with the config file specified.
     :param config_file: config file to use
     :param windows_mode: enable windows mode which bypasses the usage of mono
+    :param monitor: optional SearchMonitor polled while the trial runs, the
+     trial is terminated and TrialCancelled raised if it cancels the search
+    :param watchdog_slack: seconds added to the expected run time of the
+     config, the process group is killed and TrialTimeout raised after that
     :return: Tuple of pass or fail result as str, and current transmit rate as
     float, transmit fps, and packets lost
     """
-    user_home = os.path.expanduser('~')
-    log_path = '{}/Xena/Valkrie2544/Logs/valkyrie2544.log'.format(user_home)
-    # make the folder and log file if they doesn't exist
-    if not os.path.exists(log_path):
-        os.makedirs(os.path.dirname(log_path))
+    log_path = _valkyrie_log_path()
 
-    # empty the file contents
-    open(log_path, 'w').close()
+    # the log is not emptied, AsyncTrials in this process may be following it
+    # from saved offsets, the read below skips the text of earlier runs
 
     # setup the xena command line
-    args = ["mono" if not windows_mode else "",
-            "Valkyrie2544.exe", "-c", config_file, "-e", "-r", "./", "-u",
-            _XENA_USER]
+    args = _valkyrie_args(config_file, windows_mode)
 
     # Sometimes Valkyrie2544.exe completes, but mono holds the process without
     # releasing it, this can cause a deadlock of the main thread. Use the
@@ -512,35 +980,447 @@ def run_xena(config_file, windows_mode=False):
     # read the contents of the log before we start so the next read in the
     # wait method are only looking at the text from this test instance
     log_handle.read()
-    mono_pipe = subprocess.Popen(args, stdout=sys.stdout)
+    if monitor:
+        monitor.reset()
+    # a report left from an earlier run must not be read as this one
+    _remove_report()
+    timeout = trial_timeout(config_file, watchdog_slack)
+    deadline = time.time() + timeout
+    # own process group so mono and its children can be killed together
+    mono_pipe = subprocess.Popen(args, stdout=sys.stdout,
+                                 start_new_session=hasattr(os, 'killpg'))
     data = ''
     if _PYTHON_2:
         _LOGGER.error('Not supported yet for python 2...')
     else:
-        while True:
-            try:
-                mono_pipe.wait(60)
-                log_handle.close()
-                break
-            except subprocess.TimeoutExpired:
-                # check the log to see if Valkrie2544 has completed and mono is
-                # deadlocked.
-                data += log_handle.read()
-                if 'TestCompletedSuccessfully' in data:
+        # the new session does not get the terminal's SIGINT, stop the group
+        # on any way out of the loop so Valkyrie2544 does not keep the chassis
+        try:
+            while True:
+                try:
+                    mono_pipe.wait(max(0, min(
+                        monitor.poll_interval if monitor else 60,
+                        deadline - time.time())))
                     log_handle.close()
-                    mono_pipe.terminate()
                     break
+                except subprocess.TimeoutExpired:
+                    if time.time() >= deadline:
+                        log_handle.close()
+                        _LOGGER.error('Valkyrie2544.exe still running after '
+                                      '%s seconds, killing it', timeout)
+                        _stop_process_group(mono_pipe)
+                        raise TrialTimeout(timeout)
+                    if monitor:
+                        monitor.poll()
+                        if monitor.cancelled:
+                            log_handle.close()
+                            _stop_process_group(mono_pipe)
+                            raise TrialCancelled(monitor.last_event)
+                    # check the log to see if Valkrie2544 has completed and
+                    # mono is deadlocked.
+                    data += log_handle.read()
+                    if 'TestCompletedSuccessfully' in data:
+                        log_handle.close()
+                        _stop_process_group(mono_pipe)
+                        break
+        except BaseException:
+            log_handle.close()
+            if mono_pipe.returncode is None:
+                _stop_process_group(mono_pipe)
+            raise
+
+    if monitor:
+        # pick up the rows written after the last poll
+        monitor.poll()
 
     # parse the result file and return the needed data
-    root = ET.parse(r'./valkyrie2544-report.xml').getroot()
-    return (root[0][1][0].get('TestState'),
-            float(root[0][1][0].get('TotalTxRatePcnt')),
-            float(root[0][1][0].get('TotalTxRateFps')),
-            root[0][1][0].get('TotalLossFrames'),
-            root[0][1][0], # return whole element
+    element = _report_element()
+    return (element.get('TestState'),
+            float(element.get('TotalTxRatePcnt')),
+            float(element.get('TotalTxRateFps')),
+            element.get('TotalLossFrames'),
+            element, # return whole element
             )
 
 
+def run_trial(config_file, windows_mode=False, monitor=None,
+              watchdog_slack=_WATCHDOG_SLACK):
+    """
+    Run Valkyrie2544.exe with the config file specified.
+    :param config_file: config file to use
+    :param windows_mode: enable windows mode which bypasses the usage of mono
+    :param monitor: optional SearchMonitor, see run_xena
+    :param watchdog_slack: seconds added to the expected run time, see
+     run_xena
+    :return: TrialResult, state is CANCELLED if the monitor cancelled it and
+     TIMEOUT if the watchdog killed it
+    """
+    try:
+        element = run_xena(config_file, windows_mode, monitor,
+                           watchdog_slack)[4]
+    except TrialTimeout:
+        return TrialResult('TIMEOUT', 0.0, 0.0, 0, (), config_file)
+    except TrialCancelled as exc:
+        last = exc.event
+        return TrialResult('CANCELLED', last.rate if last else 0.0, 0.0,
+                           last.loss_frames if last else 0, (), config_file)
+    return TrialResult.from_element(element, config_file)
+
+
+async def parse_report(report_dir='./', config_file=None):
+    """
+    Parse the Valkyrie2544 xml report without blocking the event loop
+    :param report_dir: folder the report was written to
+    :param config_file: config file used for the run
+    :return: TrialResult
+    """
+    loop = asyncio.get_running_loop()
+    element = await loop.run_in_executor(None, _report_element, report_dir)
+    return TrialResult.from_element(element, config_file)
+
+
+class AsyncTrial(object):
+    """
+    Valkyrie2544.exe run driven from an asyncio event loop. Several trials,
+    monitors and report parsers can run in one process without threads as
+    long as each trial writes its report to its own report_dir.
+    """
+    def __init__(self, config_file, windows_mode=False, report_dir='./',
+                 poll_interval=1, watchdog_slack=_WATCHDOG_SLACK):
+        """
+        Constructor
+        :param config_file: config file to use
+        :param windows_mode: enable windows mode which bypasses mono
+        :param report_dir: folder the report files are written to
+        :param poll_interval: seconds between log checks
+        :param watchdog_slack: seconds added to the expected run time of the
+         config, the process group is killed and TrialTimeout raised after that
+        :return: AsyncTrial object
+        """
+        self.config_file = config_file
+        self.windows_mode = windows_mode
+        self.report_dir = report_dir
+        self.poll_interval = poll_interval
+        self.timeout = trial_timeout(config_file, watchdog_slack)
+        self.log_path = _valkyrie_log_path()
+        self.process = None
+        # log offset at start so only text from this trial is read
+        self._log_start = 0
+        self._start_time = 0
+
+    async def start(self):
+        """
+        Start Valkyrie2544.exe
+        :return: None
+        """
+        _remove_report(self.report_dir)
+        self._log_start = os.path.getsize(self.log_path)
+        self._start_time = time.time()
+        self.process = await asyncio.create_subprocess_exec(
+            *_valkyrie_args(self.config_file, self.windows_mode,
+                            self.report_dir),
+            start_new_session=hasattr(os, 'killpg'))
+
+    def _check_started(self):
+        if self.process is None:
+            raise RuntimeError('AsyncTrial.start() has not been called')
+
+    async def log_lines(self):
+        """
+        Follow the Valkyrie2544 log while the trial runs
+        :return: async generator of log lines written since the start
+        """
+        self._check_started()
+        with open(self.log_path, 'r') as log_handle:
+            log_handle.seek(self._log_start)
+            partial = ''
+            while True:
+                # check before reading so the read after the exit picks up
+                # the last lines written
+                finished = self.process.returncode is not None
+                partial += log_handle.read()
+                lines = partial.split('\n')
+                partial = lines.pop()
+                for line in lines:
+                    yield line
+                if finished:
+                    if partial:
+                        yield partial
+                    return
+                await asyncio.sleep(self.poll_interval)
+
+    async def wait(self):
+        """
+        Wait for Valkyrie2544.exe to finish. Sometimes Valkyrie2544.exe
+        completes, but mono holds the process without releasing it, the log
+        is used to detect this and the process is terminated. The log is
+        shared by concurrent trials so the report of this trial must exist too.
+        :return: process return code
+        """
+        self._check_started()
+        deadline = self._start_time + self.timeout
+        with open(self.log_path, 'r') as log_handle:
+            log_handle.seek(self._log_start)
+            data = ''
+            # the new session does not get the terminal's SIGINT, stop the
+            # group if the task is cancelled so Valkyrie2544 does not keep the
+            # chassis
+            try:
+                while True:
+                    try:
+                        return await asyncio.wait_for(
+                            self.process.wait(), max(0, min(
+                                self.poll_interval, deadline - time.time())))
+                    except asyncio.TimeoutError:
+                        if time.time() >= deadline:
+                            _LOGGER.error(
+                                'Valkyrie2544.exe still running after %s '
+                                'seconds, killing it', self.timeout)
+                            await _async_stop_process_group(self.process)
+                            raise TrialTimeout(self.timeout)
+                        data += log_handle.read()
+                        if 'TestCompletedSuccessfully' in data and \
+                                self._report_written():
+                            return await _async_stop_process_group(
+                                self.process)
+            except (asyncio.CancelledError, KeyboardInterrupt):
+                if self.process.returncode is None:
+                    await _async_stop_process_group(self.process)
+                raise
+
+    def _report_written(self):
+        report = os.path.join(self.report_dir, 'valkyrie2544-report.xml')
+        return os.path.exists(report) and \
+            os.path.getmtime(report) >= self._start_time
+
+    async def result(self):
+        """
+        Parse the report of the finished trial
+        :return: TrialResult
+        """
+        return await parse_report(self.report_dir, self.config_file)
+
+    async def run(self):
+        """
+        Start the trial, wait for it and parse its report
+        :return: TrialResult, state is TIMEOUT if the watchdog killed it
+        """
+        await self.start()
+        try:
+            await self.wait()
+        except TrialTimeout:
+            return TrialResult('TIMEOUT', 0.0, 0.0, 0, (), self.config_file)
+        return await self.result()
+
+
+async def async_run_trial(config_file, windows_mode=False, report_dir='./'):
+    """
+    Run Valkyrie2544.exe with the config file specified from an event loop.
+    :param config_file: config file to use
+    :param windows_mode: enable windows mode which bypasses the usage of mono
+    :param report_dir: folder the report files are written to
+    :return: TrialResult
+    """
+    return await AsyncTrial(config_file, windows_mode, report_dir).run()
+
+
+_INTERMEDIATE_CSV = '*ntermediate*.csv'
+# Candidate column names of the intermediate results csv, compared in lower
+# case with everything but letters and digits removed
+_CSV_COLUMNS = {
+    'packet_size': ('framesize', 'packetsize', 'size'),
+    'iteration': ('iteration', 'iter'),
+    'rate': ('txratepcnt', 'totaltxratepcnt', 'txrate', 'rate'),
+    'loss_frames': ('totallossframes', 'lossframes', 'lostframes', 'loss'),
+    'state': ('teststate', 'result', 'state', 'status'),
+}
+
+
+class TrialCancelled(Exception):
+    """
+    Raised when a SearchMonitor cancels the running trial.
+    """
+    def __init__(self, event=None):
+        super(TrialCancelled, self).__init__('Trial cancelled')
+        self.event = event
+
+
+@dataclass
+class IterationEvent(object):
+    """
+    One search iteration read from the intermediate results csv.
+    """
+    __slots__ = ('packet_size', 'iteration', 'rate', 'loss_frames', 'state')
+    packet_size: int
+    iteration: int
+    rate: float
+    loss_frames: int
+    state: str
+
+    @property
+    def passed(self):
+        return self.state.upper() in ('PASS', 'PASSED')
+
+
+def _csv_column(fieldnames, name):
+    normalized = dict((''.join(c for c in field.lower() if c.isalnum()),
+                       field) for field in fieldnames if field)
+    for candidate in _CSV_COLUMNS[name]:
+        if candidate in normalized:
+            return normalized[candidate]
+    return None
+
+
+def _csv_number(value, cast):
+    try:
+        return cast(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class SearchMonitor(object):
+    """
+    Follow valkyrie2544.log and the intermediate results csv of a running
+    search and report every iteration as soon as it is written.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, report_dir='./', callback=None, output=None,
+                 cancel_below=None, log_callback=None, poll_interval=5,
+                 csv_pattern=_INTERMEDIATE_CSV):
+        """
+        Constructor
+        :param report_dir: folder Valkyrie2544 writes its reports to
+        :param callback: callable receiving each IterationEvent, returning
+         True cancels the search
+        :param output: file object IterationEvents are written to as JSON lines
+        :param cancel_below: cancel the search once an iteration at or below
+         this rate fails
+        :param log_callback: callable receiving each new log line
+        :param poll_interval: seconds between polls
+        :param csv_pattern: glob of the intermediate csv inside report_dir
+        :return: SearchMonitor object
+        """
+        self.report_dir = report_dir
+        self.callback = callback
+        self.output = output
+        self.cancel_below = cancel_below
+        self.log_callback = log_callback
+        self.poll_interval = poll_interval
+        self.csv_pattern = csv_pattern
+        self.log_path = _valkyrie_log_path()
+        self.reset()
+
+    def reset(self):
+        """
+        Start following from the current end of the log, csv files present
+        now are from earlier runs and are skipped
+        :return: None
+        """
+        self.cancelled = False
+        self.last_event = None
+        self._log_offset = os.path.getsize(self.log_path)
+        self._log_partial = ''
+        self._start_time = time.time()
+        self._csv_state = {}
+
+    def poll(self):
+        """
+        Read what was written since the last poll
+        :return: list of new IterationEvents
+        """
+        if self.log_callback:
+            self._poll_log()
+        events = []
+        for path in sorted(glob.glob(os.path.join(self.report_dir,
+                                                  self.csv_pattern))):
+            if os.path.getmtime(path) < self._start_time:
+                continue
+            events.extend(self._poll_csv(path))
+        for event in events:
+            self._emit(event)
+        return events
+
+    def _poll_log(self):
+        if os.path.getsize(self.log_path) < self._log_offset:
+            # the log was truncated or rotated outside this process
+            self._log_offset = 0
+        with open(self.log_path, 'r') as log_handle:
+            log_handle.seek(self._log_offset)
+            data = self._log_partial + log_handle.read()
+            self._log_offset = log_handle.tell()
+        lines = data.split('\n')
+        self._log_partial = lines.pop()
+        for line in lines:
+            self.log_callback(line)
+
+    def _poll_csv(self, path):
+        state = self._csv_state.setdefault(path, {'offset': 0,
+                                                  'columns': None})
+        if os.path.getsize(path) < state['offset']:
+            # the csv was rewritten from the start
+            state.update(offset=0, columns=None)
+        with open(path, 'rb') as csv_file:
+            csv_file.seek(state['offset'])
+            data = csv_file.read()
+        # only rows terminated by a newline are complete, the rest is read
+        # again at the next poll
+        data = data[:data.rfind(b'\n') + 1]
+        state['offset'] += len(data)
+        rows = list(csv.reader(io.StringIO(data.decode('utf-8', 'replace'))))
+        if rows and state['columns'] is None:
+            fieldnames = rows.pop(0)
+            state['fieldnames'] = fieldnames
+            state['columns'] = dict((name, _csv_column(fieldnames, name))
+                                    for name in _CSV_COLUMNS)
+            if state['columns']['rate'] is None:
+                _LOGGER.warning('No rate column in %s header %s, iterations '
+                                'are not reported', path, fieldnames)
+        events = []
+        for row in rows:
+            values = dict(zip(state['fieldnames'], row))
+            values = dict((name, values.get(column) if column else None)
+                          for name, column in state['columns'].items())
+            rate = _csv_number(values['rate'], float)
+            if rate is None:
+                continue
+            events.append(IterationEvent(
+                _csv_number(values['packet_size'], int),
+                _csv_number(values['iteration'], int), rate,
+                _csv_number(values['loss_frames'], int),
+                (values['state'] or '').strip()))
+        return events
+
+    def _emit(self, event):
+        self.last_event = event
+        if self.output:
+            self.output.write(json.dumps(dict(
+                (name, getattr(event, name)) for name in event.__slots__),
+                sort_keys=True) + '\n')
+            self.output.flush()
+        if self.callback and self.callback(event):
+            self.cancelled = True
+        if self.cancel_below is not None and not event.passed and \
+                event.rate <= self.cancel_below:
+            _LOGGER.warning('Iteration at rate %s failed, at or below %s',
+                            event.rate, self.cancel_below)
+            self.cancelled = True
+
+    async def follow(self, trial):
+        """
+        Poll while an AsyncTrial runs and terminate it if cancelled
+        :param trial: started AsyncTrial
+        :return: True if the trial was cancelled
+        """
+        while trial.process.returncode is None:
+            await asyncio.sleep(self.poll_interval)
+            self.poll()
+            if self.cancelled:
+                await _async_stop_process_group(trial.process)
+                return True
+        self.poll()
+        return False
+
+
 def write_json_file(json_data, output_path):
     """
     Write out the dictionary of data to a json file
@@ -624,6 +1504,25 @@ if __name__ == '__main__':
                         default=False, action='store_true', 
                         help='Use value passed to --flow_count for MAC')
 
+    parser.add_argument('-j', '--progress_file', required=False, type=str,
+                        help='Write each search iteration as a JSON line to '
+                             'this file, - for stdout')
+    parser.add_argument('-x', '--cancel_below', required=False, type=float,
+                        help='Cancel the search once an iteration at or below '
+                             'this rate fails')
+    parser.add_argument('-L', '--latency_curve', required=False, nargs='*',
+                        type=float,
+                        help='After a passed verify run latency trials at '
+                             'these percentages of the verified rate, '
+                             'default = {}'.format(' '.join(
+                                 str(x) for x in _LATENCY_FRACTIONS)))
+    parser.add_argument('-T', '--latency_duration', required=False, type=int,
+                        help='Latency trial duration in seconds, default is '
+                             'the verify duration')
+    parser.add_argument('-g', '--watchdog_slack', required=False, type=int,
+                        default=_WATCHDOG_SLACK,
+                        help='Seconds added to the expected trial run time '
+                             'before a hung Valkyrie2544.exe is killed')
     args = parser.parse_args()
     if args.debug:
         print("DEBUG ENABLED!!!")